@@ -1,9 +1,14 @@
-import os
+import json
 import math
+import os
+import tempfile
+import time
 import requests
 from google.oauth2 import service_account
 from googleapiclient.discovery import build
+from collections import Counter
 from datetime import datetime, timezone
+from functools import lru_cache
 from dotenv import load_dotenv
 
 load_dotenv(os.path.expanduser("~/.bot.env"))
@@ -17,45 +22,101 @@ RANGE = os.environ["RANGE"]
 DISCORD_WEBHOOK_URL = os.environ["DISCORD_WEBHOOK_URL"]
 NOW = datetime.now(timezone.utc)
 WEEK_NUMBER = NOW.isocalendar()[1]  # ISO week number (1–53)
+SHEETS_CACHE_FILE = os.environ.get("SHEETS_CACHE_FILE", "/tmp/gaming_cache.json")
+SHEETS_CACHE_TTL = int(os.environ.get("SHEETS_CACHE_TTL", "0"))  # seconds, 0 = no cache
+DISCORD_HEALTH_FILE = os.environ.get("DISCORD_HEALTH_FILE", "/tmp/discord_health.json")
 
 # --- color handling with fuzzy match ---
-import math
-REFERENCE_COLORS = {
-    "available": (0.0, 1.0, 0.0),   # green
-    "tentative": (1.0, 1.0, 0.0),   # yellow
-    "unavailable": (1.0, 0.0, 0.0), # red
-    "unknown": (1.0, 1.0, 1.0),     # white / empty
-}
-def normalize_color(bg):
-    return (
-        bg.get("red", 1.0),
-        bg.get("green", 1.0),
-        bg.get("blue", 1.0),
+# statuses are kept as small ints (index into STATUSES) while crunching the grid
+STATUSES = ("available", "tentative", "unavailable", "unknown")
+AVAILABLE, TENTATIVE, UNAVAILABLE, UNKNOWN = range(len(STATUSES))
+REFERENCE_COLORS = (  # same order as STATUSES, 8 bits per channel
+    (0, 255, 0),      # green
+    (255, 255, 0),    # yellow
+    (255, 0, 0),      # red
+    (255, 255, 255),  # white / empty
+)
+# status lookup table keyed by 8-bit RGB, the precision the sheet's colors have;
+# a sheet only uses a handful of distinct colors, so it fills up after a few cells
+@lru_cache(maxsize=None)
+def _classify(r, g, b):
+    # squared distances: only used for argmin, so sqrt is not needed
+    dists = [(r-rr)**2 + (g-rg)**2 + (b-rb)**2 for rr, rg, rb in REFERENCE_COLORS]
+    return dists.index(min(dists))
+def color_to_code(bg):
+    # missing channels default to 1.0, so an empty color is white
+    return _classify(
+        int(bg.get("red", 1.0)*255 + 0.5),
+        int(bg.get("green", 1.0)*255 + 0.5),
+        int(bg.get("blue", 1.0)*255 + 0.5),
     )
-def color_distance(c1, c2):
-    return math.sqrt((c1[0]-c2[0])**2+(c1[1]-c2[1])**2+(c1[2]-c2[2])**2)
-def color_to_status(bg):
-    color = normalize_color(bg or {})
-    best_match, min_dist = "unknown", float("inf")
-    for status, ref in REFERENCE_COLORS.items():
-        dist = color_distance(color, ref)
-        if dist < min_dist:
-            min_dist = dist
-            best_match = status
-    return best_match
+def cells_to_codes(cells):
+    codes = []
+    for cell in cells:
+        fmt = cell.get("userEnteredFormat")
+        bg = fmt.get("backgroundColor") if fmt else None
+        # empty cells carry no backgroundColor at all, those are always unknown
+        codes.append(color_to_code(bg) if bg else UNKNOWN)
+    return codes
 
 # --- Google Sheets fetch ---
+# only pull what build_week_message reads, not the full cell formatting
+GRID_FIELDS = "sheets.data.rowData.values(formattedValue,userEnteredFormat.backgroundColor)"
+# built once per process; cache_discovery=False skips the file_cache warning path
+_CREDS = service_account.Credentials.from_service_account_file(SERVICE_ACCOUNT_FILE, scopes=SCOPES)
+_SHEETS = build("sheets", "v4", credentials=_CREDS, cache_discovery=False)
 def fetch_griddata(spreadsheet_id, ranges):
-    creds = service_account.Credentials.from_service_account_file(SERVICE_ACCOUNT_FILE, scopes=SCOPES)
-    service = build("sheets", "v4", credentials=creds)
-    resp = service.spreadsheets().get(spreadsheetId=spreadsheet_id, ranges=[ranges], includeGridData=True).execute()
+    resp = _SHEETS.spreadsheets().get(
+        spreadsheetId=spreadsheet_id,
+        ranges=[ranges],
+        includeGridData=True,
+        fields=GRID_FIELDS,
+    ).execute()
     return resp.get("sheets", [])[0]["data"][0].get("rowData", [])
 
+# --- optional on-disk cache of the grid, for frequent cron runs ---
+def fetch_griddata_cached(spreadsheet_id, ranges):
+    if SHEETS_CACHE_TTL <= 0:
+        return fetch_griddata(spreadsheet_id, ranges)
+    key = [spreadsheet_id, ranges]
+    try:
+        if time.time() - os.path.getmtime(SHEETS_CACHE_FILE) < SHEETS_CACHE_TTL:
+            with open(SHEETS_CACHE_FILE) as f:
+                cached = json.load(f)
+            if isinstance(cached, dict) and cached.get("key") == key:
+                return cached.get("rowData", [])
+    except (OSError, ValueError):
+        pass  # missing or broken cache, just refetch
+    rowData = fetch_griddata(spreadsheet_id, ranges)
+    # write next to the cache and swap it in, so other runs never see a partial file
+    tmp_path = None
+    try:
+        fd, tmp_path = tempfile.mkstemp(dir=os.path.dirname(SHEETS_CACHE_FILE) or ".", suffix=".tmp")
+        with os.fdopen(fd, "w") as f:
+            json.dump({"key": key, "rowData": rowData}, f)
+        os.replace(tmp_path, SHEETS_CACHE_FILE)
+    except OSError as e:
+        print(f"Could not write cache {SHEETS_CACHE_FILE}: {e}")
+        if tmp_path and os.path.exists(tmp_path):
+            os.remove(tmp_path)
+    return rowData
+
 # --- Build weekly message ---
 def build_week_message(rowData):
+    body = "\n\n".join(_iter_days(rowData))
+    #debug
+    #timestamp = datetime.now(timezone.utc).strftime("%Y-%m-%d %H:%M UTC")
+    if not body:
+        return ""  # always return a string
+
+    return f"**Kalendarzyk grania na tydzień {WEEK_NUMBER}** \n\n" + body
+
+# yields the non-empty summary of each day, in sheet order
+def _iter_days(rowData):
     header_values = rowData[0].get("values", [])
     times = [v.get("formattedValue", "").strip() for v in header_values[2:]]
-    week_summary, day_name, players = [], None, []
+    num_times = len(times)
+    day_name, status_rows = None, []
 
     for row in rowData[1:]:
         values = row.get("values", [])
@@ -65,75 +126,51 @@ def build_week_message(rowData):
         player_name = values[1].get("formattedValue", "").strip() if len(values) > 1 else ""
 
         if day_cell and day_cell.lower() not in ("dzień:", "kto:"):
-            if day_name and players:
-                day_summary = process_day(day_name, times, players)
+            if day_name and status_rows:
+                day_summary = process_day(day_name, times, status_rows)
                 if day_summary:   # skip empty string
-                    week_summary.append(day_summary)
-            day_name, players = day_cell, []
+                    yield day_summary
+            day_name, status_rows = day_cell, []
 
         if not player_name or player_name.lower() in ("kto", "kto:"):
             continue
 
-        player_statuses = {}
-        for col_idx, time in enumerate(times, start=2):
-            if col_idx < len(values):
-                cell = values[col_idx]
-                bg = cell.get("userEnteredFormat", {}).get("backgroundColor", {})
-                status = color_to_status(bg)
-                player_statuses[time] = status
-        players.append((player_name, player_statuses))
-
-    if day_name and players:
-        day_summary = process_day(day_name, times, players)
-        if day_summary:
-            week_summary.append(day_summary)
-    #debug
-    #timestamp = datetime.now(timezone.utc).strftime("%Y-%m-%d %H:%M UTC")
-    if not week_summary:
-        return ""  # always return a string
+        # one row per player, one column per time slot; rows and columns are
+        # positional, so a repeated player name or time header still counts separately
+        row = cells_to_codes(values[2:2 + num_times])
+        row.extend([UNKNOWN] * (num_times - len(row)))  # short rows: missing cells are unknown
+        status_rows.append(row)
 
-    return f"**Kalendarzyk grania na tydzień {WEEK_NUMBER}** \n\n" + "\n\n".join(week_summary)
+    if day_name and status_rows:
+        day_summary = process_day(day_name, times, status_rows)
+        if day_summary:
+            yield day_summary
 
 # --- Compress day slots into ranges ---
-def process_day(day_name, times, players):
-    total_players = len(players)
-    availability_by_time = {t: {} for t in times}
-    for player_name, statuses in players:
-        for t in times:
-            availability_by_time[t][player_name] = statuses.get(t, "unknown")
-
-    results = []
-    for t in times:
-        statuses = list(availability_by_time[t].values())
-        counts = {
-            "available": statuses.count("available"),
-            "tentative": statuses.count("tentative"),
-            "unavailable": statuses.count("unavailable"),
-            "unknown": statuses.count("unknown"),
-        }
-        if counts["available"] == total_players:
-            results.append((t, "✅ Wszyscy dostępni! Łałałiła"))
-        elif counts["available"] == 2 and counts["tentative"] == 1:
-            results.append((t, f"⚠️ Granie możliwe, dostępni (2/{total_players}, 1 niepewny)"))
-        else:
-            results.append((t, None))
+def process_day(day_name, times, status_rows):
+    total_players = len(status_rows)
+    # built once per day, so equal summaries are the same object when compressing
+    all_available = "✅ Wszyscy dostępni! Łałałiła"
+    playable = f"⚠️ Granie możliwe, dostępni (2/{total_players}, 1 niepewny)"
 
-    # compress ranges
-    compressed, start, prev_summary = [], None, None
-    for i, (time, summary) in enumerate(results):
-        if not summary:
-            if prev_summary:
-                compressed.append((start, results[i-1][0], prev_summary))
-                start, prev_summary = None, None
-            continue
-        if prev_summary == summary:
-            pass
+    # summarize and compress into ranges in one pass over the time slots
+    compressed, start, prev_t, prev_summary = [], None, None, None
+    # zip(*rows) hands back each time slot's column directly
+    for t, column in zip(times, zip(*status_rows)):
+        counts = Counter(column)
+        if counts[AVAILABLE] == total_players:
+            summary = all_available
+        elif counts[AVAILABLE] == 2 and counts[TENTATIVE] == 1:
+            summary = playable
         else:
+            summary = None
+        if summary != prev_summary:
             if prev_summary:
-                compressed.append((start, results[i-1][0], prev_summary))
-            start, prev_summary = time, summary
+                compressed.append((start, prev_t, prev_summary))
+            start, prev_summary = t, summary
+        prev_t = t
     if prev_summary:
-        compressed.append((start, results[-1][0], prev_summary))
+        compressed.append((start, prev_t, prev_summary))
 
     if not compressed:
         return ""  # always return a string
@@ -150,19 +187,80 @@ def process_day(day_name, times, players):
 
 
 # --- Discord send ---
+_HTTP = requests.Session()  # keep-alive across posts
+MAX_BACKOFF = 3600  # seconds
+DEAD_WEBHOOK_STATUSES = (401, 403, 404)
+# webhook health survives between cron runs, so a dead webhook isn't hit every time
+def load_discord_health():
+    try:
+        with open(DISCORD_HEALTH_FILE) as f:
+            health = json.load(f)
+    except (OSError, ValueError):
+        return {}
+    # the file sits in /tmp, so don't trust its shape
+    if not isinstance(health, dict):
+        return {}
+    for field in ("backoff_until", "failures"):
+        value = health.get(field, 0)
+        if isinstance(value, bool) or not isinstance(value, (int, float)) or not math.isfinite(value):
+            return {}
+    if health.get("backoff_until", 0) > time.time() + MAX_BACKOFF:
+        return {}  # we never back off longer than that, so it's bogus
+    return health
+def save_discord_health(health):
+    # same temp file + os.replace dance as the grid cache
+    tmp_path = None
+    try:
+        fd, tmp_path = tempfile.mkstemp(dir=os.path.dirname(DISCORD_HEALTH_FILE) or ".", suffix=".tmp")
+        with os.fdopen(fd, "w") as f:
+            json.dump(health, f)
+        os.replace(tmp_path, DISCORD_HEALTH_FILE)
+    except OSError as e:
+        print(f"Could not write {DISCORD_HEALTH_FILE}: {e}")
+        if tmp_path and os.path.exists(tmp_path):
+            os.remove(tmp_path)
 def send_to_discord(message):
     if not DISCORD_WEBHOOK_URL:
         print("No Discord webhook configured.")
         return
-    resp = requests.post(DISCORD_WEBHOOK_URL, json={"content": message})
-    if resp.status_code != 204:
-        print(f"Discord error {resp.status_code}: {resp.text}")
+    if not message:
+        print("Nothing to send this week.")  # Discord rejects empty content with a 400
+        return
+    health = load_discord_health()
+    now = time.time()
+    if now < health.get("backoff_until", 0):
+        print(f"Skipping Discord post, last status {health.get('last_status')}, backing off until "
+              f"{datetime.fromtimestamp(health['backoff_until'], timezone.utc):%Y-%m-%d %H:%M UTC}")
+        return
+    try:
+        resp = _HTTP.post(DISCORD_WEBHOOK_URL, json={"content": message}, timeout=10)
+    except requests.RequestException as e:
+        print(f"Discord error: {e}")
+        return  # timeouts and connection errors say nothing about the webhook, no backoff
+    if resp.status_code == 204:
+        if health:
+            save_discord_health({})
+        return
+    print(f"Discord error {resp.status_code}: {resp.text}")
+    if resp.status_code == 429:
+        try:
+            retry_after = min(float(resp.headers.get("Retry-After", 60)), MAX_BACKOFF)
+        except ValueError:
+            retry_after = 60
+        health = {"last_status": 429, "failures": health.get("failures", 0), "backoff_until": now + retry_after}
+    elif resp.status_code in DEAD_WEBHOOK_STATUSES:  # revoked or wrong webhook, back off exponentially
+        failures = health.get("failures", 0) + 1
+        backoff = min(60 * 2 ** (failures - 1), MAX_BACKOFF)
+        health = {"last_status": resp.status_code, "failures": failures, "backoff_until": now + backoff}
+    else:
+        return  # bad request or 5xx: not the webhook's fault, try again next run
+    save_discord_health(health)
 
 # --- Main ---
 def main():
     sheet_name = f"Week_{WEEK_NUMBER}"
     sheet_name_and_range = f"{sheet_name}!{RANGE}"
-    data = fetch_griddata(SPREADSHEET_ID, sheet_name_and_range)
+    data = fetch_griddata_cached(SPREADSHEET_ID, sheet_name_and_range)
     msg = build_week_message(data)
     print(msg)
     send_to_discord(msg)